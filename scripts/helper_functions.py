@@ -7,12 +7,21 @@ import pickle
 import geopandas as gpd
 import rasterio
 import itertools
+import uuid
+import collections
+import shutil
+import glob
+import functools
+import re
+import pyarrow as pa
+import pyarrow.dataset as ds
 
 from scipy import interpolate
 from osgeo import gdal, osr, ogr  # Python bindings for GDAL
 from rasterio.mask import mask
 from shapely.geometry import mapping
 from multiprocessing import Pool  # Parallel computing
+from concurrent.futures import ThreadPoolExecutor  # background raster reads, GDAL releases the GIL while decoding
 
 # worldpop extent and resolution specification
 wp_xmin = -180.0012
@@ -55,6 +64,42 @@ global_mask = rasterio.open('./data/misc/global_mask.tif')
 path_pop = "./data/worldpop/worldpop_all"
 path_pop_age_gender = "./data/worldpop/worldpop_age_gender"
 path_dur = "./data/tc/duration/"  # file path for tropical cyclone durations
+path_results_store = "./results/results_store"  # consolidated parquet dataset for all tabular results
+
+# raster prefetching: number of rasters decoded ahead of the computation, and memory budget for them (bytes)
+prefetch_count = 2
+prefetch_max_bytes = 8 * 1024 ** 3
+
+# incremental ingest of new years: running sums, counts and per-year provenance, see script_ingest_year.py
+path_ingest = "./results/ingest"
+rdi_window_years = 10  # number of years of the country rdi window (2010-2019 in script_Figure4.py)
+
+# fixed schema of each product saved in the results store
+results_schema = {
+    'total_pop_exp': pa.schema([('year', pa.int32()), ('wind_cutoff', pa.string()),
+                                ('landfall_cutoff', pa.string()), ('total_pop', pa.float64())]),
+    'age_gender_exp': pa.schema([('year', pa.int32()), ('wind_cutoff', pa.string()), ('duration', pa.int32()),
+                                 ('continent', pa.string()), ('age', pa.int32()), ('gender', pa.string()),
+                                 ('pop_exp', pa.float64())]),
+    'age_gender_unexp': pa.schema([('year', pa.int32()), ('wind_cutoff', pa.string()),
+                                   ('continent', pa.string()), ('age', pa.int32()), ('gender', pa.string()),
+                                   ('pop_exp', pa.float64())]),
+    'continent_exp': pa.schema([('year', pa.int32()), ('wind_cutoff', pa.string()),
+                                ('continent', pa.string()), ('pop_exp', pa.float64())]),
+    'region_person_day': pa.schema([('UID', pa.int64()), ('NAME_0', pa.string()), ('NAME_1', pa.string()),
+                                    ('NAME_2', pa.string()), ('NAME_3', pa.string()), ('NAME_4', pa.string()),
+                                    ('NAME_5', pa.string()), ('COUNTRY', pa.string()), ('CONTINENT', pa.string()),
+                                    ('avg_person_days', pa.float64()), ('geometry', pa.binary())]),
+}
+# hive partition columns of each product (e.g. year=...), used for predicate pushdown on reads; the small tables are
+# only partitioned by year to keep the number of files low, see compact_results()
+results_partition_cols = {
+    'total_pop_exp': ['year'],
+    'age_gender_exp': ['year'],
+    'age_gender_unexp': ['year'],
+    'continent_exp': ['year'],
+    'region_person_day': ['CONTINENT'],
+}
 
 
 def get_continent_indices():
@@ -85,6 +130,15 @@ def get_continent_indices():
     return None
 
 
+@functools.lru_cache(maxsize=None)
+def load_continent_indices():
+    """
+    Load the indices of each continent saved by get_continent_indices(); the file is only read once per process
+    """
+    with open(f'./data/misc/continent_indices.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
 def get_country_indices():
     """
     Obtain the indices corresponding to each country within the WorldPop resolution.
@@ -113,6 +167,20 @@ def get_country_indices():
     return None
 
 
+def get_latest_country_rdi_file(window_years: int = rdi_window_years):
+    """
+    File name of the country rdi table (see script_Figure4.py) with the latest final year among the tables covering
+    window_years years, e.g. ./results/country_rdi_exp_unexp_2011_2020.csv after ingesting 2020 with
+    script_ingest_year.py. Same with get_latest_country_rdi_file() in helper_functions.R.
+    """
+    rdi_files = {}
+    for file in glob.glob('./results/country_rdi_exp_unexp_*_*.csv'):
+        years = re.search(r'country_rdi_exp_unexp_(\d{4})_(\d{4})\.csv$', file)
+        if years is not None and int(years.group(2)) - int(years.group(1)) + 1 == window_years:
+            rdi_files[int(years.group(2))] = file
+    return rdi_files[max(rdi_files)]
+
+
 def get_multiple_year_exposure(year_start: int, year_to: int, windstat: str):
     """
     Obtain the grid cells that were exposed to a certain level of wind intensity over multiple years.
@@ -127,16 +195,16 @@ def get_multiple_year_exposure(year_start: int, year_to: int, windstat: str):
         duration_multi_year - 2d array of dimension [18720, 43200] of 0/1 represents whether the grid was exposed
     """
     duration_multi_year = np.zeros(wp_dimensions)
-    for year in np.arange(year_start, year_to + 1):
-        duration = gdal.Open(f'{path_dur}/duration_{year}_{windstat}.tif')
-        duration = np.array(duration.GetRasterBand(1).ReadAsArray()).astype(float)
+    year_list = np.arange(year_start, year_to + 1)
+    duration_files = [f'{path_dur}/duration_{year}_{windstat}.tif' for year in year_list]
+    for year, duration in zip(year_list, prefetch_rasters(duration_files)):
         duration = np.flip(duration, axis=0)
         duration_multi_year[duration >= 1] = 1
         print(f'finished get multiple year exposure: year = {year}')
     return duration_multi_year
 
 
-def save_numpy_to_tif(data, output_tif_file: str, tiftype: str):
+def save_numpy_to_tif(data, output_tif_file: str, tiftype: str, metadata=None):
     """
     Save 2D numpy array to tif file
 
@@ -146,6 +214,8 @@ def save_numpy_to_tif(data, output_tif_file: str, tiftype: str):
         tiftype: a string represents the data type, options are:
             'int': tif file will be saved in 16-bit integer (Int 16) format.
             'float': tif file will be saved in 32-bit floating point (Float 32)  format.
+            'double': tif file will be saved in 64-bit floating point (Float 64) format, e.g. for running sums.
+        metadata: optional dictionary of strings saved in the tif metadata
     """
     driver = gdal.GetDriverByName('GTiff')
     # Get dimensions
@@ -155,6 +225,8 @@ def save_numpy_to_tif(data, output_tif_file: str, tiftype: str):
         data_type = gdal.GDT_Byte  # gdal.GDT_Int16
     elif tiftype == 'float':
         data_type = gdal.GDT_Float32  # gdal.GDT_Float32,
+    elif tiftype == 'double':
+        data_type = gdal.GDT_Float64
     else:
         print('Error: invalid data type!')
     # Create a temp grid
@@ -168,6 +240,8 @@ def save_numpy_to_tif(data, output_tif_file: str, tiftype: str):
     # Setup projection and geo-transform
     grid_data.SetProjection(srs.ExportToWkt())
     grid_data.SetGeoTransform(get_geo_transform(wp_extent, nlines, ncols))
+    if metadata is not None:
+        grid_data.SetMetadata(metadata)
     # Save to .gif file
     driver.CreateCopy(output_tif_file, grid_data, 0)
     driver = None
@@ -197,6 +271,14 @@ def weighted_avg(A, weights):
     return np.nansum(A * weights) / np.nansum((~np.isnan(A)) * weights)
 
 
+def get_exp_raster_files(year: int, windstat: str):
+    """
+    File names of the population and tropical cyclone duration rasters used to compute exposure in a particular year,
+    see calc_tot_exp_pop() and prefetch_rasters()
+    """
+    return f'{path_pop}/ppp_{year}_1km_Aggregated.tif', f'{path_dur}/duration_{year}_{windstat}.tif'
+
+
 def calc_tot_exp_pop(year: int, windstat: str):
     """
     Determine the total population exposure to a specific tropical cyclone intensity in a particular year.
@@ -210,14 +292,18 @@ def calc_tot_exp_pop(year: int, windstat: str):
     Returns:
         exp_map: a number represents the total population exposure 
     """
-    wp = gdal.Open(f'{path_pop}/ppp_{year}_1km_Aggregated.tif')
-    wp = np.array(wp.GetRasterBand(1).ReadAsArray())
+    wp, wd = [read_raster(file) for file in get_exp_raster_files(year, windstat)]
+    return compute_exp_pop(wp, wd)
+
+
+def compute_exp_pop(wp, wd):
+    """
+    Same with calc_tot_exp_pop(), but for population (wp) and duration (wd) arrays that are already read
+    """
     wp = np.round(wp)
     # Due to potential float read errors, set arbitrarily large or small values to 0
     wp[wp <= 0] = 0
     wp[wp >= 1e10] = 0
-    wd = gdal.Open(f'{path_dur}/duration_{year}_{windstat}.tif')
-    wd = np.array(wd.GetRasterBand(1).ReadAsArray())
     wd = wd.astype('float32')
     wd = np.flip(wd, axis=0)
     wd[wd <= 0] = 0
@@ -239,17 +325,241 @@ def calc_tot_exp_person_day(year: int, windstat: str):
     Returns:
         exp_map: a number represents the total population exposure 
     """
-    wp = gdal.Open(f'{path_pop}/ppp_{year}_1km_Aggregated.tif')
-    wp = np.array(wp.GetRasterBand(1).ReadAsArray())
+    wp, wd = [read_raster(file) for file in get_exp_raster_files(year, windstat)]
+    return compute_exp_person_day(wp, wd)
+
+
+def compute_exp_person_day(wp, wd):
+    """
+    Same with calc_tot_exp_person_day(), but for population (wp) and duration (wd) arrays that are already read
+    """
     wp = np.round(wp)
     # Due to potential float read errors, set arbitrarily large or small values to 0
     wp[wp <= 0] = 0
     wp[wp >= 1e10] = 0
-    wd = gdal.Open(f'{path_dur}/duration_{year}_{windstat}.tif')
-    wd = np.array(wd.GetRasterBand(1).ReadAsArray())
     wd = wd.astype('float32')
     wd = np.flip(wd, axis=0)
     wd[wd <= 0] = 0
     wd = wd / 8  # duration data is provided with a temporal resolution of 3 hours
     exp_map = np.multiply(wd, wp)
     return exp_map
+
+
+def read_raster(file: str):
+    """
+    Read the first band of a raster file into a numpy array
+    """
+    raster = gdal.Open(file)
+    return np.array(raster.GetRasterBand(1).ReadAsArray())
+
+
+def get_raster_bytes(file: str):
+    """
+    Memory (bytes) needed to read a raster with read_raster(), obtained from the file header only
+    """
+    raster = gdal.Open(file)
+    band = raster.GetRasterBand(1)
+    return raster.RasterXSize * raster.RasterYSize * gdal.GetDataTypeSize(band.DataType) // 8
+
+
+def prefetch(operation, input, item_bytes: int, n_prefetch: int = prefetch_count,
+             max_bytes: int = prefetch_max_bytes):
+    """
+    Run operation on each element of input in a background thread pool and yield the results in order, so that the
+    next elements are read while the current one is being computed.
+    The memory budget only covers the results of this call, so prefetch() should not be nested.
+
+    Args:
+        operation - function applied to each element of input, e.g. read_raster()
+        input - list of arguments of operation
+        item_bytes - memory (bytes) of one result, used to bound the number of results held in memory
+        n_prefetch - maximum number of results computed ahead of the consumer
+        max_bytes - memory budget (bytes) for the results computed ahead; if one result does not fit in the budget,
+            the elements are computed one at a time without prefetching
+    """
+    n_ahead = int(min(n_prefetch, max_bytes // max(item_bytes, 1)))
+    if n_ahead < 1:
+        for arg in input:
+            yield operation(arg)
+        return
+    input = iter(input)
+    with ThreadPoolExecutor(max_workers=n_ahead) as executor:
+        futures = collections.deque()
+        for arg in itertools.islice(input, n_ahead):
+            futures.append(executor.submit(operation, arg))
+        while futures:
+            result = futures.popleft().result()
+            for arg in itertools.islice(input, 1):
+                futures.append(executor.submit(operation, arg))
+            yield result
+            result = None  # release the array before waiting for the next one
+
+
+def prefetch_rasters(files: list, n_prefetch: int = prefetch_count, max_bytes: int = prefetch_max_bytes):
+    """
+    Iterate over rasters while the next ones are decoded in the background, see prefetch()
+
+    Args:
+        files - list of raster files; an element can also be a tuple of files that are needed together
+            (e.g. population and duration of the same year, see get_exp_raster_files()), which yields a tuple of arrays
+        n_prefetch, max_bytes - see prefetch()
+
+    Returns:
+        generator of numpy arrays (or tuples of numpy arrays), in the order of files
+    """
+    if len(files) == 0:
+        return iter([])
+
+    def read_raster_group(file_group):
+        return tuple([read_raster(file) for file in file_group])
+
+    if isinstance(files[0], str):
+        return prefetch(read_raster, files, get_raster_bytes(files[0]), n_prefetch, max_bytes)
+    item_bytes = sum([get_raster_bytes(file) for file in files[0]])
+    return prefetch(read_raster_group, files, item_bytes, n_prefetch, max_bytes)
+
+
+def get_results_partitioning(product: str):
+    """
+    Hive partitioning of a product in the results store, typed with the product schema
+    """
+    schema = results_schema[product]
+    return ds.partitioning(pa.schema([schema.field(col) for col in results_partition_cols[product]]),
+                           flavor='hive')
+
+
+def write_results(results_df, product: str, output_dir=None):
+    """
+    Append a data frame to the results store. Only one process should write at a time, see write_results_stream().
+
+    Args:
+        results_df - data frame containing (at least) all columns of results_schema[product]
+        product - name of the result product; options are the keys of results_schema:
+            'total_pop_exp', 'age_gender_exp', 'age_gender_unexp', 'continent_exp', 'region_person_day'
+        output_dir - directory of the dataset to append to; None appends to the product in the results store
+    """
+    if output_dir is None:
+        output_dir = f'{path_results_store}/{product}'
+    table = pa.Table.from_pandas(results_df, schema=results_schema[product], preserve_index=False)
+    ds.write_dataset(table, output_dir, format='parquet',
+                     partitioning=get_results_partitioning(product),
+                     basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+    return None
+
+
+def write_results_stream(results, product: str, batch_size: int = 50, overwrite: bool = False):
+    """
+    Single writer for parallel jobs: consume data frames as the workers return them and append them to the
+    results store in batches, so that only the main process writes and each batch becomes one file per partition.
+
+    Args:
+        results - iterable of data frames (or None for skipped jobs), e.g. the output of pool.imap_unordered()
+        product - name of the result product, see write_results()
+        batch_size - number of data frames to collect before writing
+        overwrite - if True, replace all existing data of the product instead of appending. The replacement is
+            written next to the product and only swapped in once all results are written.
+    """
+    product_dir = f'{path_results_store}/{product}'
+    output_dir = product_dir
+    if overwrite:
+        output_dir = f'{product_dir}_new'
+        # remove the leftovers of an interrupted replacement
+        shutil.rmtree(output_dir, ignore_errors=True)
+        shutil.rmtree(f'{product_dir}_old', ignore_errors=True)
+    batch = []
+    try:
+        for results_df in results:
+            if results_df is None or results_df.shape[0] == 0:
+                continue
+            batch.append(results_df)
+            if len(batch) >= batch_size:
+                write_results(pd.concat(batch, ignore_index=True), product, output_dir)
+                batch = []
+    finally:
+        # save the finished jobs even if a job failed, so that a restart skips them
+        if len(batch) > 0:
+            write_results(pd.concat(batch, ignore_index=True), product, output_dir)
+    if overwrite:
+        if not os.path.isdir(output_dir):
+            print(f'no results to save: product = {product}')
+            return None
+        if os.path.isdir(product_dir):
+            os.replace(product_dir, f'{product_dir}_old')
+        os.replace(output_dir, product_dir)
+        shutil.rmtree(f'{product_dir}_old', ignore_errors=True)
+    return None
+
+
+def compact_results(product: str):
+    """
+    Rewrite a product of the results store as one file per partition, merging the files written by each batch.
+    Only meant for the small tabular products, which are read into memory at once.
+    """
+    if not os.path.isdir(f'{path_results_store}/{product}'):
+        return None
+    write_results_stream([read_results(product)], product, overwrite=True)
+    return None
+
+
+def read_results(product: str, filters=None, columns=None):
+    """
+    Read a product from the results store. Filters on partition columns (year, CONTINENT) prune whole directories,
+    other filters are pushed down to the parquet row groups.
+
+    Args:
+        product - name of the result product, see write_results()
+        filters - optional pyarrow dataset expression, e.g.
+            (ds.field('year') >= 2002) & (ds.field('wind_cutoff') == 'ts')
+        columns - optional list of columns to read
+
+    Returns:
+        results_df - data frame of the selected rows and columns; empty if nothing has been written yet
+    """
+    if columns is None:
+        columns = results_schema[product].names
+    if not os.path.isdir(f'{path_results_store}/{product}'):
+        return pd.DataFrame(columns=columns)
+    dataset = ds.dataset(f'{path_results_store}/{product}', schema=results_schema[product], format='parquet',
+                         partitioning=get_results_partitioning(product))
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
+
+
+def get_computed_keys(product: str, key_cols: list):
+    """
+    Obtain the jobs that are already saved in the results store, replacing per-file os.path.isfile() checks.
+
+    Args:
+        product - name of the result product, see write_results()
+        key_cols - list of columns identifying a job, e.g. ['year', 'wind_cutoff', 'landfall_cutoff']
+
+    Returns:
+        set of tuples with the key values of every computed job
+    """
+    computed_df = read_results(product, columns=key_cols)
+    return set(computed_df.itertuples(index=False, name=None))
+
+
+def load_ingest_state():
+    """
+    Load the state of the incremental ingest, see script_ingest_year.py
+
+    Returns:
+        ingest_state - dictionary with, for each raster product, the list of ingested years (per-year provenance)
+            and the time each year was ingested; empty if no year has been ingested yet
+    """
+    if not os.path.isfile(f'{path_ingest}/ingest_state.pkl'):
+        return {}
+    with open(f'{path_ingest}/ingest_state.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+def save_ingest_state(ingest_state: dict):
+    """
+    Save the state of the incremental ingest, see load_ingest_state()
+    """
+    os.makedirs(path_ingest, exist_ok=True)
+    with open(f'{path_ingest}/ingest_state_temp.pkl', 'wb') as fs:
+        pickle.dump(ingest_state, fs)
+    os.replace(f'{path_ingest}/ingest_state_temp.pkl', f'{path_ingest}/ingest_state.pkl')
+    return None
@@ -5,49 +5,68 @@ Data preparation for Figure 1. This script includes two steps:
     - function get_total_person_day_exposure()
 
 2. Calculate the total person-day exposure for each administrative area in each country.
-    - function get_total_person_day_exposure()
+    - function extract_country_person_day(), saved in the results store as product 'region_person_day'
 """
 
 from helper_functions import *
 
 PROCESSER_COUNT = 8
 
-# load global admin borders
-data = gpd.read_file("./data/misc/gadm_410.gpkg")
+year_list = range(2019, 2001, -1)
+
+# global admin borders (data) are loaded in helper_functions.py
 
 # load exposed country list; data in this table is generated with script_Figure4.py
-country_exposed_list_df = pd.read_csv('./misc/supplementary_table1.csv')
+country_exposed_list_df = pd.read_csv('./data/misc/supplementary_table1.csv')
 country_exposed_list = country_exposed_list_df['country'].to_list()
 
 
+def get_total_person_days_file(year_start: int, year_to: int):
+    """
+    File name of the gridded total person-day exposure averaged between the years year_start and year_to
+    """
+    return f'./results/total_person_days_{year_start}_{year_to}.tif'
+
+
 def get_total_person_day_exposure():
     """
     Get gridded total person-day exposure between the years 2002 and 2019
     """
     total_person_days = np.zeros(wp_dimensions)
-    for year in range(2019, 2001, -1):
+    # rasters of the next years are read in the background while the current year is computed
+    raster_list = prefetch_rasters([get_exp_raster_files(year, 'ts_12h') for year in year_list])
+    for year, (wp, wd) in zip(year_list, raster_list):
         print(f'start: year  = {year}')
         # compute yearly person day exposure
-        exp_map = calc_tot_exp_person_day(year, 'ts_12h')
+        exp_map = compute_exp_person_day(wp, wd)
         total_person_days = total_person_days + exp_map
-    total_person_days = total_person_days / 18
-    save_numpy_to_tif(total_person_days, './results/total_person_days_2002_2019.tif', 'float')
+    total_person_days = total_person_days / len(year_list)
+    save_numpy_to_tif(total_person_days, get_total_person_days_file(min(year_list), max(year_list)), 'float')
+
 
+def get_store_country_name(country: str):
+    """
+    Country name as saved in the COUNTRY column of GADM
+    """
+    if country == 'Mexico':
+        country = 'México'
+    return country.replace("Is.", "Islands")
 
-def extract_country_person_day(country: str):
+
+def extract_country_person_day(country: str, total_person_days_file: str):
     """
     Calculate the total person-day exposure for each administrative area in each country
     Args:
         country - country name
+        total_person_days_file - gridded total person-day exposure, see get_total_person_day_exposure()
     Returns:
-        Save person_day_exposure of each administrative area in each country as file: person_day_{country}_full.shp.zip
+        country_person_day_df - person_day_exposure of each administrative area in the country, with the geometry
+        encoded as WKB
     """
-    if country == 'Mexico':
-        country = 'México'
-    country = country.replace("Is.", "Islands")
+    country = get_store_country_name(country)
     country_data = data.loc[(data['COUNTRY'] == country),]
     # load total person_day exposure (.tif file)
-    total_duration = gdal.Open(f'./results/total_person_days_2002_2019.tif')
+    total_duration = gdal.Open(total_person_days_file)
     total_duration = np.array(total_duration.GetRasterBand(1).ReadAsArray())
     total_duration[total_duration == 0] = np.nan
     # start computing
@@ -67,37 +86,43 @@ def extract_country_person_day(country: str):
         else:
             country_data['avg_person_days'].iloc[i] = np.nansum(grid_person_days) / len(row)
             print(f'processing: country = {country}, i = {i}/{len(geomslist)}')
-    country_person_day_gdf = country_data[['UID', 'NAME_0', 'NAME_1', 'NAME_2', 'NAME_3', 'NAME_4', 'NAME_5',
-                                           'COUNTRY', 'CONTINENT', 'geometry', 'avg_person_days']]
-    country_person_day_gdf.to_file(f'/data/region_person_day_method3/person_day_{country}_full.shp.zip')
-    country_person_day_gdf = country_data[
-        country_data['avg_person_days'] != 0][['UID', 'NAME_0', 'NAME_1', 'NAME_2', 'NAME_3', 'NAME_4', 'NAME_5',
-                                               'COUNTRY', 'CONTINENT', 'geometry', 'avg_person_days']]
-    if country_person_day_gdf.shape[0] != 0:
-        country_person_day_gdf.to_file(f'./results/region_person_day/person_day_{country}.shp.zip')
+    country_person_day_df = pd.DataFrame(country_data[['UID', 'NAME_0', 'NAME_1', 'NAME_2', 'NAME_3', 'NAME_4',
+                                                       'NAME_5', 'COUNTRY', 'CONTINENT', 'avg_person_days']])
+    country_person_day_df['geometry'] = country_data.geometry.apply(lambda geom: geom.wkb).values
+    return country_person_day_df
 
 
 def run_parallel_process(operation, input, pool):
-    pool.map(operation, input)
+    return pool.imap_unordered(operation, input)
 
 
-def parallel_compute_person_day(input_index):
+def parallel_compute_person_day(input_index, total_person_days_file=None):
+    if total_person_days_file is None:
+        total_person_days_file = get_total_person_days_file(min(year_list), max(year_list))
     country = country_exposed_list[input_index]
     if '/' in country:
         print('country name not valid')
-    elif os.path.isfile(f'./results/region_person_day/person_day_{country}.shp.zip'):
-        print(f'already exist: country={country}')
-    else:
-        print(f'start: country={country}')
-        extract_country_person_day(country)
-        print(f'saved shp file: country={country}')
+        return None
+    print(f'start: country={country}')
+    country_person_day_df = extract_country_person_day(country, total_person_days_file)
+    print(f'computed: country={country}')
+    return country_person_day_df
 
 
 def main():
     processes_pool = Pool(PROCESSER_COUNT)
-    arg = range(len(country_exposed_list))
     get_total_person_day_exposure()
-    run_parallel_process(parallel_compute_person_day, arg, processes_pool)
+    # skip the countries that are already saved in the results store, and the countries without admin areas in
+    # GADM, which return no rows and would otherwise be recomputed on every run
+    computed = get_computed_keys('region_person_day', ['COUNTRY'])
+    gadm_country_list = set(data['COUNTRY'])
+    arg = [i for i in range(len(country_exposed_list))
+           if (get_store_country_name(country_exposed_list[i]),) not in computed
+           and get_store_country_name(country_exposed_list[i]) in gadm_country_list]
+    print(f'already exist: {len(country_exposed_list) - len(arg)} of {len(country_exposed_list)} countries')
+    # workers return data frames, the main process is the single writer of the results store
+    write_results_stream(run_parallel_process(parallel_compute_person_day, arg, processes_pool),
+                         'region_person_day', batch_size=10)
 
 
 if __name__ == '__main__':
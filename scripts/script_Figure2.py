@@ -16,7 +16,7 @@ from helper_functions import *
 
 PROCESSER_COUNT = 4  # parallel computing
 
-path_total_exp = './results/total_pop_exp/'  # path to save results
+results_product = 'total_pop_exp'  # product in the results store to save results
 
 year_list = np.arange(2019, 2001, -1)
 wind_cutoff_list = ['ts', 'cat1', 'cat3']
@@ -34,6 +34,8 @@ def get_landfall_exposure(year: int, wind_stat: str, landfall_cutoff: str):
             'ts', 'cat1', 'cat2', 'cat3', 'cat4', 'cat5'
         landfall_cutoff: assuming up to 6 hour, 12 hours, and no limit of sustained winds over land; options are:
             '6h', '12h', 'all'
+    Returns:
+        exposure_df - one-row data frame to be saved in the results store
     """
     pop_exp = []
     exp_map = calc_tot_exp_pop(year, wind_stat + '_' + landfall_cutoff)
@@ -41,32 +43,34 @@ def get_landfall_exposure(year: int, wind_stat: str, landfall_cutoff: str):
     total_pop_exp = np.nansum(exp_map)
     pop_exp.append([year, wind_stat, landfall_cutoff, total_pop_exp])
     exposure_df = pd.DataFrame(pop_exp, columns=['year', 'wind_cutoff', 'landfall_cutoff', 'total_pop'])
-    exposure_df.to_csv(
-        f'{path_total_exp}/exposure_{year}_{wind_stat}_{landfall_cutoff}.csv',
-        index=False)
     print(f'finish: year = {year}, landfall_cutoff = {landfall_cutoff}, windcutoff = {wind_stat}')
+    return exposure_df
 
 
 def run_parallel_process(operation, input, pool):
-    pool.map(operation, input)
+    return pool.imap_unordered(operation, input)
 
 
 def compute_exposure(input_index):
     year = arg_list[input_index][0]
     wind_stat = arg_list[input_index][1]
     landfall_cutoff = arg_list[input_index][2]
-    if os.path.isfile(f'{path_total_exp}/exposure_{year}_{wind_stat}_{landfall_cutoff}.csv'):
-        print(f'already exist: year = {year}, landfall_cutoff = {landfall_cutoff}, windcutoff = {wind_stat}')
-    else:
-        print(f'start computing: year = {year}, landfall_cutoff = {landfall_cutoff}, windcutoff = {wind_stat}')
-        get_landfall_exposure(year, wind_stat, landfall_cutoff)
-        print(f'finish computing year = {year}, wind_stat={wind_stat}')
+    print(f'start computing: year = {year}, landfall_cutoff = {landfall_cutoff}, windcutoff = {wind_stat}')
+    exposure_df = get_landfall_exposure(year, wind_stat, landfall_cutoff)
+    print(f'finish computing year = {year}, wind_stat={wind_stat}')
+    return exposure_df
 
 
 def main():
     processes_pool = Pool(PROCESSER_COUNT)
-    arg = range(len(arg_list))
-    run_parallel_process(compute_exposure, arg, processes_pool)
+    # skip the jobs that are already saved in the results store
+    computed = get_computed_keys(results_product, ['year', 'wind_cutoff', 'landfall_cutoff'])
+    arg = [i for i in range(len(arg_list)) if tuple(arg_list[i]) not in computed]
+    print(f'already exist: {len(arg_list) - len(arg)} of {len(arg_list)} jobs')
+    # workers return data frames, the main process is the single writer of the results store
+    write_results_stream(run_parallel_process(compute_exposure, arg, processes_pool), results_product)
+    # merge the files of each batch into one file per year
+    compact_results(results_product)
 
 
 if __name__ == '__main__':
@@ -17,8 +17,7 @@ from helper_functions import *
 PROCESSER_COUNT = 10  # number of parallel computing cores
 
 # load continent indices
-with open(f'./data/misc/continent_indices.pkl', 'rb') as f:
-    continent_indices = pickle.load(f)
+continent_indices = load_continent_indices()
 continent_list = list(continent_indices.keys())
 
 # generate arg list for parallel computing:
@@ -36,6 +35,8 @@ def extract_age_gender_exposed_population(year: int, wind_stat: str, age: int, g
         wind_stat: wind intensity threshold; options are: 'ts', 'cat1', 'cat2', 'cat3', 'cat4', 'cat5'
         age: age group
         gender: options are 'f', 'm'
+    Returns:
+        exposure_df - data frame to be saved in the results store as product 'age_gender_exp'
     """
     age_gender_pop_data = []
     wp = gdal.Open(f'{path_pop_age_gender}/global_{gender}_{age}_{year}_1km.tif')
@@ -61,13 +62,13 @@ def extract_age_gender_exposed_population(year: int, wind_stat: str, age: int, g
             age_gender_pop_data.append([year, wind_stat, duration_cutoff, continent, age, gender, continent_pop_exp])
     exposure_df = pd.DataFrame(age_gender_pop_data,
                                columns=['year', 'wind_cutoff', 'duration', 'continent', 'age', 'gender', 'pop_exp'])
-    exposure_df.to_csv(f'./results/age_gender_exp/age_gender_exposure_{year}_{wind_stat}_{age}_{gender}.csv',
-                       index=False)
+    return exposure_df
 
 
 def extract_age_gender_unexposed_population(year: int, wind_stat: str, age: int, gender: str):
     """
-    Same with extract_age_gender_exposed_population(), but for unexposed population
+    Same with extract_age_gender_exposed_population(), but for unexposed population; the returned data frame is
+    saved in the results store as product 'age_gender_unexp'
     """
     age_gender_unexp_pop_data = []
     wp = gdal.Open(f'{path_pop_age_gender}/global_{gender}_{age}_{year}_1km.tif')
@@ -93,12 +94,11 @@ def extract_age_gender_unexposed_population(year: int, wind_stat: str, age: int,
 
     unexposure_df = pd.DataFrame(age_gender_unexp_pop_data,
                                  columns=['year', 'wind_cutoff', 'continent', 'age', 'gender', 'pop_exp'])
-    unexposure_df.to_csv(f'./results/age_gender_unexp/age_gender_unexposed_{year}_{wind_stat}_{age}_{gender}.csv',
-                         index=False)
+    return unexposure_df
 
 
 def run_parallel_process(operation, input, pool):
-    pool.map(operation, input)
+    return pool.imap_unordered(operation, input)
 
 
 def get_age_gender_exposure(input_index):
@@ -106,17 +106,22 @@ def get_age_gender_exposure(input_index):
     wind_stat = arg_list[input_index][1]
     age = arg_list[input_index][2]
     gender = arg_list[input_index][3]
-    if os.path.isfile(f'./results/age_gender_exp/age_gender_exposure_{year}_{wind_stat}_{age}_{gender}.csv'):
-        print(f'already exist: year = {year}, wind={wind_stat}, age = {age}, gender = {gender}')
-    else:
-        extract_age_gender_exposed_population(year, wind_stat, age, gender)
-        print(f'saved csv file: year = {year}, wind={wind_stat}, age = {age}, gender = {gender}')
+    exposure_df = extract_age_gender_exposed_population(year, wind_stat, age, gender)
+    print(f'computed: year = {year}, wind={wind_stat}, age = {age}, gender = {gender}')
+    return exposure_df
 
 
 def main():
     processes_pool = Pool(PROCESSER_COUNT)
-    arg = range(len(arg_list))
-    run_parallel_process(get_age_gender_exposure, arg, processes_pool)
+    # skip the jobs that are already saved in the results store
+    computed = get_computed_keys('age_gender_exp', ['year', 'wind_cutoff', 'age', 'gender'])
+    arg = [i for i in range(len(arg_list)) if tuple(arg_list[i]) not in computed]
+    print(f'already exist: {len(arg_list) - len(arg)} of {len(arg_list)} jobs')
+    # workers return data frames, the main process is the single writer of the results store
+    write_results_stream(run_parallel_process(get_age_gender_exposure, arg, processes_pool), 'age_gender_exp',
+                         batch_size=10)
+    # merge the files of each batch into one file per year
+    compact_results('age_gender_exp')
 
 
 if __name__ == '__main__':
@@ -14,62 +14,97 @@ Requirements:
 
 from helper_functions import *
 
-with open(f'./data/misc/country_indices.pkl', 'rb') as f:
-    country_indices = pickle.load(f)
-country_list = list(country_indices.keys())
-
-# load global gridded relative deprivation data
-povrdi = gdal.Open('./data/misc/povmap-grdi-v1_high_res_global.tif')
-povrdi = np.array(povrdi.GetRasterBand(1).ReadAsArray()).astype(float)
-povrdi = np.flip(povrdi, axis=0)  # flip rdi map to be consistent with duration data
-
-# load global population data at 2015
-worldpop = gdal.Open(f'{path_pop}/ppp_2015_1km_Aggregated.tif')
-worldpop = np.array(worldpop.GetRasterBand(1).ReadAsArray())
-worldpop = np.round(worldpop)
-# Due to potential float read errors, set arbitrarily large or small values to NaN
-worldpop[worldpop <= 0] = np.NAN
-worldpop[worldpop >= 1e10] = np.NAN
-
 wind_cutoff_list = ['ts_12h', 'cat1_12h', 'cat2_12h', 'cat3_12h', 'cat4_12h', 'cat5_12h']
 
 
-def compute_country_rdi():
+def load_country_rdi_data():
+    """
+    Load the inputs of get_country_rdi(); they are only loaded when needed because the rasters are large
+
+    Returns:
+        country_indices - indices of each country, see get_country_indices()
+        povrdi - global gridded relative deprivation data
+        worldpop - global population data at 2015
+    """
+    with open(f'./data/misc/country_indices.pkl', 'rb') as f:
+        country_indices = pickle.load(f)
+
+    # load global gridded relative deprivation data
+    povrdi = gdal.Open('./data/misc/povmap-grdi-v1_high_res_global.tif')
+    povrdi = np.array(povrdi.GetRasterBand(1).ReadAsArray()).astype(float)
+    povrdi = np.flip(povrdi, axis=0)  # flip rdi map to be consistent with duration data
+
+    # load global population data at 2015
+    worldpop = gdal.Open(f'{path_pop}/ppp_2015_1km_Aggregated.tif')
+    worldpop = np.array(worldpop.GetRasterBand(1).ReadAsArray())
+    worldpop = np.round(worldpop)
+    # Due to potential float read errors, set arbitrarily large or small values to NaN
+    worldpop[worldpop <= 0] = np.NAN
+    worldpop[worldpop >= 1e10] = np.NAN
+    return country_indices, povrdi, worldpop
+
+
+def get_country_rdi(thres: str, duration, country_indices, povrdi, worldpop):
+    """
+    Calculate the rdi of the exposed and unexposed populations of each country for one wind threshold
+
+    Args:
+        thres - wind intensity threshold, see wind_cutoff_list
+        duration - 2d array of 0/1 represents whether the grid was exposed, see get_multiple_year_exposure()
+        country_indices, povrdi, worldpop - see load_country_rdi_data()
+    Returns:
+        rdi_data - list of rows of the rdi table, see save_country_rdi()
+    """
     rdi_data = []
-    for thres in wind_cutoff_list:
-        # load tropical cyclone duration exposure
-        duration = get_multiple_year_exposure(2010, 2019, thres)
-        for country in country_list:
-            print(f'processing country: country = {country}')
-            grid_population = worldpop[country_indices[country][0][0], country_indices[country][0][1]]
-            grid_tc_duration = duration[country_indices[country][0][0], country_indices[country][0][1]]
-            grid_rdi = povrdi[country_indices[country][0][0], country_indices[country][0][1]]
-            if np.sum(grid_tc_duration) == 0:
-                continue
-            total_popultaion = np.nansum(grid_population)
-            if total_popultaion == 0:
-                continue
-            # compute population-averaged rdi for each country
-            total_avg_rdi = weighted_avg(grid_rdi, grid_population)
-            # compute total number of exposed population
-            exposed_population = np.nansum(grid_population[grid_tc_duration > 0])
-            if exposed_population == 0:
-                continue
-            # compute total number of unexposed population
-            unexposed_population = np.nansum(grid_population[grid_tc_duration == 0])
-            # compute population-averaged rdi for exposed population
-            exposed_avg_rdi = weighted_avg(grid_rdi[grid_tc_duration > 0], grid_population[grid_tc_duration > 0])
-            # compute population-averaged rdi for unexposed population
-            unexposed_avg_rdi = weighted_avg(grid_rdi[grid_tc_duration == 0], grid_population[grid_tc_duration == 0])
-            # prepare data row
-            country_data = [country, thres,
-                            total_popultaion, exposed_population, unexposed_population,
-                            total_avg_rdi, exposed_avg_rdi, unexposed_avg_rdi]
-            rdi_data.append(country_data)
+    for country in country_indices.keys():
+        print(f'processing country: country = {country}')
+        grid_population = worldpop[country_indices[country][0][0], country_indices[country][0][1]]
+        grid_tc_duration = duration[country_indices[country][0][0], country_indices[country][0][1]]
+        grid_rdi = povrdi[country_indices[country][0][0], country_indices[country][0][1]]
+        if np.sum(grid_tc_duration) == 0:
+            continue
+        total_popultaion = np.nansum(grid_population)
+        if total_popultaion == 0:
+            continue
+        # compute population-averaged rdi for each country
+        total_avg_rdi = weighted_avg(grid_rdi, grid_population)
+        # compute total number of exposed population
+        exposed_population = np.nansum(grid_population[grid_tc_duration > 0])
+        if exposed_population == 0:
+            continue
+        # compute total number of unexposed population
+        unexposed_population = np.nansum(grid_population[grid_tc_duration == 0])
+        # compute population-averaged rdi for exposed population
+        exposed_avg_rdi = weighted_avg(grid_rdi[grid_tc_duration > 0], grid_population[grid_tc_duration > 0])
+        # compute population-averaged rdi for unexposed population
+        unexposed_avg_rdi = weighted_avg(grid_rdi[grid_tc_duration == 0], grid_population[grid_tc_duration == 0])
+        # prepare data row
+        country_data = [country, thres,
+                        total_popultaion, exposed_population, unexposed_population,
+                        total_avg_rdi, exposed_avg_rdi, unexposed_avg_rdi]
+        rdi_data.append(country_data)
+    return rdi_data
+
+
+def save_country_rdi(rdi_data: list, year_start: int, year_to: int):
+    """
+    Save the rdi table of the exposure between year_start and year_to
+    """
     rdi_df = pd.DataFrame(rdi_data, columns=['country', 'wind_cutoff', 'total_pop', 'exposed_pop', 'unexposed_pop',
                                              'avg_rdi', 'exposed_avg_rdi', 'unexposed_avg_rdi'])
-    rdi_df.to_csv('./results/country_rdi_exp_unexp_2010_2019.csv',
+    rdi_df.to_csv(f'./results/country_rdi_exp_unexp_{year_start}_{year_to}.csv',
                   index=False)
+    return f'./results/country_rdi_exp_unexp_{year_start}_{year_to}.csv'
+
+
+def compute_country_rdi():
+    country_indices, povrdi, worldpop = load_country_rdi_data()
+    rdi_data = []
+    for thres in wind_cutoff_list:
+        # load tropical cyclone duration exposure; the yearly rasters are prefetched in get_multiple_year_exposure()
+        duration = get_multiple_year_exposure(2010, 2019, thres)
+        rdi_data = rdi_data + get_country_rdi(thres, duration, country_indices, povrdi, worldpop)
+    save_country_rdi(rdi_data, 2010, 2019)
 
 
 def main():
@@ -1,7 +1,8 @@
 """
 Data preparation for Figure ED1 (continent exposure).
 
-This script computes total population exposure for each continent.
+This script computes total population exposure for each continent, saved in the results store as product
+'continent_exp'.
 
 Requirements:
     1. continent_indices.pkl
@@ -12,27 +13,45 @@ Requirements:
 from helper_functions import *
 
 wind_cutoff_list = ['ts_12h']
+year_list = range(2019, 2001, -1)
 
 # load continent indices
-with open(f'./data/misc/continent_indices.pkl', 'rb') as f:
-    continent_indices = pickle.load(f)
+continent_indices = load_continent_indices()
 continent_list = list(continent_indices.keys())
 
 
-def compute_continent_exposure():
+def get_continent_exposure(year: int, wind_stat: str, wp, wd):
+    """
+    Calculates the total population exposure for each continent in a particular year
+
+    Args:
+        wp, wd - population and duration arrays of the year, see get_exp_raster_files()
+    Returns:
+        exposure_df - data frame to be saved in the results store as product 'continent_exp'
+    """
     exp_pop_data = []
+    exp_map = compute_exp_pop(wp, wd)
+    total_pop_exp = np.nansum(exp_map)
+    exp_pop_data.append([year, wind_stat, 'all', total_pop_exp])
+    for continent in continent_list:
+        continent_pop_exp = np.nansum(
+            exp_map[continent_indices[continent][0][0], continent_indices[continent][0][1]])
+        exp_pop_data.append([year, wind_stat, continent, continent_pop_exp])
+    print(f'finish: year = {year}, wind_cutoff = {wind_stat}')
+    return pd.DataFrame(exp_pop_data, columns=['year', 'wind_cutoff', 'continent', 'pop_exp'])
+
+
+def compute_continent_exposure():
+    # skip the years that are already saved in the results store
+    computed = get_computed_keys('continent_exp', ['year', 'wind_cutoff'])
     for wind_stat in wind_cutoff_list:
-        for year in range(2019, 2001, -1):
-            exp_map = calc_tot_exp_pop(year, wind_stat)
-            total_pop_exp = np.nansum(exp_map)
-            exp_pop_data.append([year, wind_stat, 'all', total_pop_exp])
-            for continent in continent_list:
-                continent_pop_exp = np.nansum(
-                    exp_map[continent_indices[continent][0][0], continent_indices[continent][0][1]])
-                exp_pop_data.append([year, wind_stat, continent, continent_pop_exp])
-            print(f'finish: year = {year}, wind_cutoff = {wind_stat}')
-    exposure_df = pd.DataFrame(exp_pop_data, columns=['year', 'wind_cutoff', 'continent', 'pop_exp'])
-    exposure_df.to_csv('./results/exposure_population_data.csv', index=False)
+        years = [year for year in year_list if (year, wind_stat) not in computed]
+        # rasters of the next years are read in the background while the current year is computed
+        raster_list = prefetch_rasters([get_exp_raster_files(year, wind_stat) for year in years])
+        write_results_stream((get_continent_exposure(year, wind_stat, wp, wd)
+                              for year, (wp, wd) in zip(years, raster_list)), 'continent_exp')
+    # merge the files of each batch into one file per year
+    compact_results('continent_exp')
 
 
 def main():
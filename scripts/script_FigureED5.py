@@ -4,24 +4,29 @@ Data preparation for Figure ED5 (within-country rdi distribution).
 The function extract_country_rdi_distribution() saves Relative Deprivation Index of all grids for each exposed country
 
 Requirements:
-    1. country_rdi_exp_unexp_2010_2019.csv, computed from script_Figure4.py
+    1. country_rdi_exp_unexp_{year_start}_{year_to}.csv, computed from script_Figure4.py (or script_ingest_year.py)
     2. global gridded relative deprivation index (https://sedac.ciesin.columbia.edu/data/set/povmap-grdi-v1)
 """
 
 from helper_functions import *
 
-# load country indices
-with open(f'./data/misc/country_indices.pkl', 'rb') as f:
-    country_indices = pickle.load(f)
 
-# load global gridded relative deprivation data
-povrdi = gdal.Open('./data/misc/povmap-grdi-v1_high_res_global_flip.tif')
-povrdi = np.array(povrdi.GetRasterBand(1).ReadAsArray()).astype(float)
-povrdi = np.flip(povrdi, axis=0)  # flip rdi map to be consistent with duration data
+def extract_country_rdi_distribution(country_rdi_file: str):
+    """
+    Save the Relative Deprivation Index of all grids for each country of the country rdi table
+    Args:
+        country_rdi_file - country rdi table, see get_latest_country_rdi_file()
+    """
+    # load country indices
+    with open(f'./data/misc/country_indices.pkl', 'rb') as f:
+        country_indices = pickle.load(f)
 
+    # load global gridded relative deprivation data
+    povrdi = gdal.Open('./data/misc/povmap-grdi-v1_high_res_global_flip.tif')
+    povrdi = np.array(povrdi.GetRasterBand(1).ReadAsArray()).astype(float)
+    povrdi = np.flip(povrdi, axis=0)  # flip rdi map to be consistent with duration data
 
-def extract_country_rdi_distribution():
-    country_rdi = pd.read_csv('./results/country_rdi_exp_unexp_2010_2019.csv')
+    country_rdi = pd.read_csv(country_rdi_file)
     country_list = country_rdi['country'].unique()
     for country in country_list:
         print(f'processing country: country = {country}')
@@ -34,7 +39,7 @@ def extract_country_rdi_distribution():
 
 
 def main():
-    extract_country_rdi_distribution()
+    extract_country_rdi_distribution(get_latest_country_rdi_file())
 
 
 if __name__ == '__main__':
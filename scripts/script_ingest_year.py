@@ -0,0 +1,308 @@
+"""
+Incremental update of all aggregate products when a new year of data is added (e.g. 2020 WorldPop and duration
+data), without recomputing the years that are already ingested. Only the rasters of the new year are read, plus,
+for the rolling window average, the rasters of the year that leaves the window.
+
+Usage:
+    python script_ingest_year.py 2002 2019   # first run: initialize the running sums with all years of the paper
+    python script_ingest_year.py 2020        # then ingest each new year
+The first run has to cover the years of the paper (2002-2019), otherwise the aggregate products would only
+average the few ingested years.
+
+For each ingested year, this script updates:
+1. gridded person-day exposure (Figure 1): running sums over all ingested years and over the rolling window,
+    saved as averages in total_person_days_{year_start}_{year_to}.tif
+    - function update_person_days()
+2. multi-year exposure (Figure 4, Figure 5): the last year each grid was exposed for each wind threshold, which gives
+    the exposure over any window ending at the new year
+    - function update_last_exposed_year()
+3. yearly tables in the results store (Figure 2, Figure 3, Figure ED1): only the jobs of the new year are computed
+    - function update_yearly_tables()
+After the last year, the products derived from the running sums are rebuilt if they are older than the last ingested
+year (function update_derived_products()): the gridded person-day averages, the person-day averages of each
+administrative area (Figure 1), the country rdi table of the rolling window (Figure 4, Figure 5) and the
+within-country rdi distributions (Figure ED5).
+
+The ingested years of each raster product, the time they were ingested, and the last year each derived product
+was built for are saved with save_ingest_state(). Years have to be ingested in order, without gaps, for the
+rolling window to be updated correctly. Each running sum records the last year it includes in its metadata, so that
+a year is never added twice if a run stops before the state is saved, and derived products interrupted by a stopped
+run are rebuilt by the next run.
+
+Requirements:
+    1. continent_indices.pkl, country_indices.pkl and the inputs of script_Figure4.py
+    2. global gridded population dataset from worldpop, and age and gender structures
+    3. global gridded tropical cyclone exposure data
+"""
+
+import sys
+import functools
+
+from helper_functions import *
+import script_Figure1 as fig1
+import script_Figure2 as fig2
+import script_Figure3 as fig3
+import script_Figure4 as fig4
+import script_FigureED1 as figED1
+import script_FigureED5 as figED5
+
+PROCESSER_COUNT = 8
+
+rolling_window = rdi_window_years  # number of years of the rolling window, e.g. 2010-2019 for Figure 4
+person_day_wind = 'ts_12h'  # wind threshold of the person-day exposure in Figure 1
+# the first run has to ingest at least the years of the paper, 2002-2019
+initial_year_start = min(fig1.year_list)
+initial_year_to = max(fig1.year_list)
+
+
+def check_ingest_year(product_state: dict, product: str, year: int):
+    """
+    Check whether a year should be added to a raster product: returns False if it is already ingested, and raises
+    ValueError if it does not directly follow the last ingested year
+    """
+    ingested_years = product_state['years']
+    if year in ingested_years:
+        print(f'already ingested: product = {product}, year = {year}')
+        return False
+    if len(ingested_years) > 0 and year != max(ingested_years) + 1:
+        raise ValueError(f'product = {product}, year = {year} does not follow the last ingested year '
+                         f'{max(ingested_years)}')
+    return True
+
+
+def update_running_sum(sum_file: str, year: int, first_year: bool, get_exp_map):
+    """
+    Add the exposure of a year to a running sum saved in Float 64, and record the year in the tif metadata.
+    The sum is written to a temporary file and then renamed, so the saved sum either includes the year or not.
+
+    Args:
+        sum_file - tif file of the running sum
+        year - year to add
+        first_year - True if no year is ingested yet, the running sum then starts from 0
+        get_exp_map - function returning the exposure to add, only called if the year is not in the sum yet
+    """
+    if os.path.isfile(sum_file) and gdal.Open(sum_file).GetMetadataItem('last_year') == str(year):
+        # the year was already added by a run that stopped before saving the ingest state
+        return None
+    if first_year:
+        running_sum = get_exp_map()
+    else:
+        running_sum = read_raster(sum_file) + get_exp_map()
+    sum_file_temp = sum_file.replace('.tif', '_new.tif')
+    save_numpy_to_tif(running_sum, sum_file_temp, 'double', metadata={'last_year': str(year)})
+    os.replace(sum_file_temp, sum_file)
+    return None
+
+
+def update_person_days(year: int, ingest_state: dict):
+    """
+    Add the person-day exposure of a new year to the running sums over all ingested years and over the rolling
+    window; the averages are saved by save_person_days_average()
+    """
+    product_state = ingest_state.setdefault('person_days', {'years': {}})
+    if not check_ingest_year(product_state, 'person_days', year):
+        return None
+    first_year = len(product_state['years']) == 0
+    exp_map_list = []
+
+    def get_exp_map():
+        # the rasters of the year are only read if one of the running sums does not include the year yet
+        if len(exp_map_list) == 0:
+            exp_map_list.append(calc_tot_exp_person_day(year, person_day_wind).astype(float))
+        return exp_map_list[0]
+
+    def get_window_exp_map():
+        # the year that leaves the rolling window is recomputed from its own rasters
+        if year - rolling_window in product_state['years']:
+            return get_exp_map() - calc_tot_exp_person_day(year - rolling_window, person_day_wind)
+        return get_exp_map()
+
+    update_running_sum(f'{path_ingest}/person_days_sum.tif', year, first_year, get_exp_map)
+    update_running_sum(f'{path_ingest}/person_days_window_sum.tif', year, first_year, get_window_exp_map)
+    exp_map_list = None
+    product_state['years'][year] = time.strftime('%Y-%m-%d %H:%M:%S')
+    save_ingest_state(ingest_state)
+    print(f'finish person days: year = {year}')
+
+
+def update_last_exposed_year(year: int, ingest_state: dict):
+    """
+    Update the last year each grid was exposed, for each wind threshold of Figure 4. The grids exposed between
+    year_start and the last ingested year are then last_exposed_year >= year_start, see get_multiple_year_exposure()
+    """
+    thres_list = [thres for thres in fig4.wind_cutoff_list
+                  if check_ingest_year(ingest_state.setdefault(f'last_exposed_year_{thres}', {'years': {}}),
+                                       f'last_exposed_year_{thres}', year)]
+    duration_files = [f'{path_dur}/duration_{year}_{thres}.tif' for thres in thres_list]
+    for thres, duration in zip(thres_list, prefetch_rasters(duration_files)):
+        product_state = ingest_state[f'last_exposed_year_{thres}']
+        duration = np.flip(duration, axis=0)
+        if len(product_state['years']) == 0:
+            last_exposed_year = np.zeros(wp_dimensions)
+        else:
+            last_exposed_year = read_raster(f'{path_ingest}/last_exposed_year_{thres}.tif')
+        last_exposed_year[duration >= 1] = year
+        # years are exact in Float 32, and setting the year again after a stopped run gives the same raster
+        save_numpy_to_tif(last_exposed_year, f'{path_ingest}/last_exposed_year_{thres}_new.tif', 'float')
+        os.replace(f'{path_ingest}/last_exposed_year_{thres}_new.tif', f'{path_ingest}/last_exposed_year_{thres}.tif')
+        product_state['years'][year] = time.strftime('%Y-%m-%d %H:%M:%S')
+        save_ingest_state(ingest_state)
+        print(f'finish last exposed year: year = {year}, wind_cutoff = {thres}')
+
+
+def compute_landfall_exposure(job):
+    year, wind_stat, landfall_cutoff = job
+    return fig2.get_landfall_exposure(year, wind_stat, landfall_cutoff)
+
+
+def compute_age_gender_exposure(job):
+    year, wind_stat, age, gender = job
+    return fig3.extract_age_gender_exposed_population(year, wind_stat, age, gender)
+
+
+def update_yearly_tables(year: int, processes_pool):
+    """
+    Compute the jobs of a new year that are not yet saved in the results store, for Figure 2, Figure 3 and Figure ED1
+    """
+    # Figure 2: total population exposure
+    computed = get_computed_keys('total_pop_exp', ['year', 'wind_cutoff', 'landfall_cutoff'])
+    arg = [job for job in itertools.product([year], fig2.wind_cutoff_list, fig2.landfall_list) if job not in computed]
+    write_results_stream(processes_pool.imap_unordered(compute_landfall_exposure, arg), 'total_pop_exp')
+    # Figure 3: age and gender distribution of exposed population
+    computed = get_computed_keys('age_gender_exp', ['year', 'wind_cutoff', 'age', 'gender'])
+    arg = [job for job in itertools.product([year], fig3.wind_cutoff_list, fig3.age_list, fig3.gender_list)
+           if job not in computed]
+    write_results_stream(processes_pool.imap_unordered(compute_age_gender_exposure, arg), 'age_gender_exp',
+                         batch_size=10)
+    # Figure ED1: continent exposure
+    computed = get_computed_keys('continent_exp', ['year', 'wind_cutoff'])
+    for wind_stat in figED1.wind_cutoff_list:
+        if (year, wind_stat) in computed:
+            continue
+        wp, wd = [read_raster(file) for file in get_exp_raster_files(year, wind_stat)]
+        write_results(figED1.get_continent_exposure(year, wind_stat, wp, wd), 'continent_exp')
+    print(f'finish yearly tables: year = {year}')
+
+
+def save_person_days_average(ingested_years: dict):
+    """
+    Save the gridded person-day averages over all ingested years and over the rolling window (Figure 1)
+    """
+    year_start = min(ingested_years)
+    year_to = max(ingested_years)
+    window_start = max(year_start, year_to - rolling_window + 1)
+    save_numpy_to_tif(read_raster(f'{path_ingest}/person_days_sum.tif') / len(ingested_years),
+                      fig1.get_total_person_days_file(year_start, year_to), 'float')
+    save_numpy_to_tif(read_raster(f'{path_ingest}/person_days_window_sum.tif') / (year_to - window_start + 1),
+                      fig1.get_total_person_days_file(window_start, year_to), 'float')
+
+
+def update_region_person_day(ingested_years: dict, processes_pool):
+    """
+    Recompute the person-day averages of each administrative area from the average over all ingested years.
+    This only reads the averaged raster, not the rasters of each year.
+    """
+    total_person_days_file = fig1.get_total_person_days_file(min(ingested_years), max(ingested_years))
+    operation = functools.partial(fig1.parallel_compute_person_day, total_person_days_file=total_person_days_file)
+    results = processes_pool.imap_unordered(operation, range(len(fig1.country_exposed_list)))
+    # all countries are recomputed, so the batches are written next to the product, which is replaced at the end
+    write_results_stream(results, 'region_person_day', batch_size=10, overwrite=True)
+
+
+def get_rdi_window(ingest_state: dict):
+    """
+    Rolling window (year_start, year_to) of the country rdi table, ending at the last ingested year
+    """
+    window_list = []
+    for thres in fig4.wind_cutoff_list:
+        ingested_years = ingest_state[f'last_exposed_year_{thres}']['years']
+        year_to = max(ingested_years)
+        window_list.append((max(min(ingested_years), year_to - rolling_window + 1), year_to))
+    if len(set(window_list)) != 1:
+        raise ValueError(f'the wind thresholds {fig4.wind_cutoff_list} have different ingested years: {window_list}')
+    return window_list[0]
+
+
+def update_country_rdi(year_start: int, year_to: int):
+    """
+    Recompute the country rdi table (Figure 4, Figure 5) between year_start and year_to, and the within-country
+    rdi distributions of its countries (Figure ED5)
+    """
+    country_indices, povrdi, worldpop = fig4.load_country_rdi_data()
+    rdi_data = []
+    for thres in fig4.wind_cutoff_list:
+        last_exposed_year = read_raster(f'{path_ingest}/last_exposed_year_{thres}.tif')
+        duration = (last_exposed_year >= year_start).astype(float)
+        last_exposed_year = None
+        rdi_data = rdi_data + fig4.get_country_rdi(thres, duration, country_indices, povrdi, worldpop)
+    country_indices = povrdi = worldpop = duration = None
+    country_rdi_file = fig4.save_country_rdi(rdi_data, year_start, year_to)
+    figED5.extract_country_rdi_distribution(country_rdi_file)
+
+
+def update_derived_products(processes_pool):
+    """
+    Rebuild each product derived from the running sums if it was built for an earlier year than the last ingested
+    year, including the products of a run that stopped before they were rebuilt
+    """
+    ingest_state = load_ingest_state()
+    derived_state = ingest_state.setdefault('derived', {})
+    ingested_years = ingest_state['person_days']['years']
+    if min(ingested_years) > initial_year_start or max(ingested_years) < initial_year_to:
+        print(f'the derived products are built once {initial_year_start}-{initial_year_to} are ingested')
+        return None
+    year_to = max(ingested_years)
+    if derived_state.get('person_days_average', 0) < year_to:
+        save_person_days_average(ingested_years)
+        derived_state['person_days_average'] = year_to
+        save_ingest_state(ingest_state)
+    if derived_state.get('region_person_day', 0) < year_to:
+        update_region_person_day(ingested_years, processes_pool)
+        derived_state['region_person_day'] = year_to
+        save_ingest_state(ingest_state)
+    rdi_year_start, rdi_year_to = get_rdi_window(ingest_state)
+    if derived_state.get('country_rdi', 0) < rdi_year_to:
+        update_country_rdi(rdi_year_start, rdi_year_to)
+        derived_state['country_rdi'] = rdi_year_to
+        save_ingest_state(ingest_state)
+    print(f'finish derived products: year = {year_to}')
+
+
+def ingest_year(year: int, processes_pool):
+    """
+    Ingest one year into the running sums and the yearly tables
+    """
+    ingest_state = load_ingest_state()
+    print(f'start ingest: year = {year}')
+    update_person_days(year, ingest_state)
+    update_last_exposed_year(year, ingest_state)
+    update_yearly_tables(year, processes_pool)
+    print(f'finish ingest: year = {year}')
+
+
+def main():
+    usage = 'usage: python script_ingest_year.py year_start [year_to]'
+    if len(sys.argv) not in [2, 3] or not all([year.isdigit() for year in sys.argv[1:]]):
+        print(usage)
+        sys.exit(1)
+    year_start, year_to = int(sys.argv[1]), int(sys.argv[-1])
+    if year_start > year_to:
+        print(f'Error: year_start = {year_start} is after year_to = {year_to}!')
+        print(usage)
+        sys.exit(1)
+    if len(load_ingest_state().get('person_days', {'years': {}})['years']) == 0 and \
+            (year_start != initial_year_start or year_to < initial_year_to):
+        print(f'Error: the first run has to ingest {initial_year_start}-{initial_year_to}, e.g. '
+              f'python script_ingest_year.py {initial_year_start} {initial_year_to}')
+        sys.exit(1)
+    processes_pool = Pool(PROCESSER_COUNT)
+    for year in range(year_start, year_to + 1):
+        ingest_year(year, processes_pool)
+    # merge the files written for each year into one file per year
+    for product in ['total_pop_exp', 'age_gender_exp', 'continent_exp']:
+        compact_results(product)
+    update_derived_products(processes_pool)
+
+
+if __name__ == '__main__':
+    main()